@@ -1,9 +1,7 @@
-import os
 import crud
 import schemas
-from jose import jwt
+from jwt import PyJWTError
 from database import get_db
-from datetime import timedelta
 from sqlalchemy.orm import Session
 from utils import send_verification_email
 from fastapi.security import OAuth2PasswordRequestForm
@@ -32,10 +30,7 @@ def login_for_access_token(db: Session = Depends(get_db), form_data: OAuth2Passw
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=crud.ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = crud.create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
-    )
+    access_token = crud.create_access_token(data={"sub": user.email})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @router.post("/register", response_model=schemas.User)
@@ -45,6 +40,7 @@ async def register_user(user: schemas.UserCreate, background_tasks: BackgroundTa
     It takes a UserCreate object as input, which is validated by Pydantic.
     If the email address already exists in the database, it raises an HTTPException with status code 409 (Conflict).
     Otherwise, it creates a new user and returns that user's information.
+    The verification email is sent in the background once the response has been returned.
 
     :param user: schemas.UserCreate: Pass in the user data from the request body
     :param background_tasks: BackgroundTasks: Add a task to the background queue
@@ -57,7 +53,7 @@ async def register_user(user: schemas.UserCreate, background_tasks: BackgroundTa
         raise HTTPException(status_code=409, detail="Email already registered")
     new_user = crud.create_user(db=db, user=user)
     token = crud.create_access_token(data={"sub": new_user.email})
-    await send_verification_email(new_user.email, token)
+    background_tasks.add_task(send_verification_email, new_user.email, token)
     return new_user
 
 
@@ -65,7 +61,7 @@ async def register_user(user: schemas.UserCreate, background_tasks: BackgroundTa
 def verify_email(token: str, db: Session = Depends(get_db)):
     """
     The verify_email function is used to verify a user's email address.
-    It takes in the token that was sent to the user's email and decodes it using JWT.
+    It takes in the token that was sent to the user's email and decodes it using PyJWT.
     If the token is valid, then we set the user's account as active.
 
     :param token: str: Pass the token to the function
@@ -79,15 +75,13 @@ def verify_email(token: str, db: Session = Depends(get_db)):
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, os.getenv("SECRET_KEY"), algorithms=[crud.ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-    except jwt.JWTError:
+        email = crud.decode_access_token(token)["sub"]
+    except PyJWTError:
         raise credentials_exception
     user = crud.get_user(db, email=email)
     if user is None:
         raise credentials_exception
     user.is_active = True
     db.commit()
+    crud.invalidate_cached_user(email)
     return {"msg": "Email verified successfully"}
\ No newline at end of file
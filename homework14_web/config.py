@@ -3,9 +3,15 @@ from pydantic_settings import BaseSettings
 from pydantic import ConfigDict, field_validator, EmailStr
 
 class Settings(BaseSettings):
+    TESTING: bool = False
     SQLALCHEMY_DATABASE_URL: str = "sqlite:///./mydb.db"
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 60
     SECRET_KEY_JWT: str = "1234567890"
     ALGORITHM: str = "HS256"
+    ARGON2_TIME_COST: int = 2
+    ARGON2_MEMORY_COST: int = 19456
+    ARGON2_PARALLELISM: int = 1
     MAIL_USERNAME: EmailStr = "mail@mail.com"
     MAIL_PASSWORD: str = "12345678"
     MAIL_FROM: str = "mail@mail.com"
@@ -0,0 +1,214 @@
+import os
+from datetime import date
+from contextlib import contextmanager
+
+os.environ["TESTING"] = "1"
+# The app's own engine is only used by its lifespan in the tests; keep it in memory so no mydb.db files are created.
+os.environ["SQLALCHEMY_DATABASE_URL"] = "sqlite://"
+
+import crud
+import pytest
+from main import app
+from database import Base, get_db, IN_MEMORY_DATABASE_URLS
+from models import create_search_indexes
+from sqlalchemy.orm import raiseload
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.orm import sessionmaker
+from fastapi.testclient import TestClient
+
+# TEST_DATABASE_URL may point the tests at an SQLite file instead, e.g. sqlite:///./test_{worker}.db for one file per xdist worker.
+DATABASE_URL = os.environ.get("TEST_DATABASE_URL", "sqlite:///:memory:").format(worker=os.environ.get("PYTEST_XDIST_WORKER", "main"))
+
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+@event.listens_for(engine, "connect")
+def disable_pysqlite_transactions(dbapi_connection, connection_record):
+    """
+    The disable_pysqlite_transactions function stops the sqlite3 driver from beginning and committing transactions on its own,
+    which breaks SAVEPOINTs. SQLAlchemy then emits BEGIN itself, see begin_sqlite_transaction.
+
+    :param dbapi_connection: The new sqlite3 connection
+    :param connection_record: The pool record of the connection
+    :return: None
+    :doc-author: Trelent
+    """
+    dbapi_connection.isolation_level = None
+
+def set_test_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    The set_test_sqlite_pragmas function is a connect event listener for a test database kept in a file.
+    The tests need no durability, so the journal is switched to WAL with synchronous=OFF and nothing is ever fsynced,
+    and temporary tables are kept in memory.
+
+    :param dbapi_connection: The new sqlite3 connection
+    :param connection_record: The pool record of the connection
+    :return: None
+    :doc-author: Trelent
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+if DATABASE_URL not in IN_MEMORY_DATABASE_URLS:
+    event.listen(engine, "connect", set_test_sqlite_pragmas)
+
+@event.listens_for(engine, "begin")
+def begin_sqlite_transaction(connection):
+    """
+    The begin_sqlite_transaction function emits BEGIN when SQLAlchemy starts a transaction on the test engine.
+
+    :param connection: The connection the transaction is started on
+    :return: None
+    :doc-author: Trelent
+    """
+    connection.exec_driver_sql("BEGIN")
+
+def override_get_db():
+    try:
+        db = TestingSessionLocal()
+        yield db
+    finally:
+        db.close()
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    """
+    The database function is a session fixture that creates the schema and the contact search indexes of the in-memory test database once
+    and points the get_db dependency of the app at it. The schema is dropped after the whole test session.
+
+    :return: None
+    :doc-author: Trelent
+    """
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        create_search_indexes(connection)
+    app.dependency_overrides[get_db] = override_get_db
+    yield
+    app.dependency_overrides.pop(get_db, None)
+    Base.metadata.drop_all(bind=engine)
+
+@pytest.fixture
+def db():
+    """
+    The db function is a fixture that runs the test inside a transaction which is rolled back afterwards.
+    It opens a connection, begins the outer transaction and binds a session to it that turns every commit into a SAVEPOINT release,
+    and the app's get_db dependency yields that same session. Teardown is a single ROLLBACK, so every test starts
+    from an empty database no matter which tests ran before it. The users and token claims cached by crud are dropped as well,
+    so nothing a test cached leaks into the next one.
+
+    :return: A database session
+    :doc-author: Trelent
+    """
+    connection = engine.connect()
+    transaction = connection.begin()
+    db = TestingSessionLocal(bind=connection, join_transaction_mode="create_savepoint")
+    app.dependency_overrides[get_db] = lambda: db
+    try:
+        yield db
+    finally:
+        app.dependency_overrides[get_db] = override_get_db
+        db.close()
+        transaction.rollback()
+        connection.close()
+        crud._token_cache.clear()
+        crud._claims_cache.clear()
+
+def add_raiseload(orm_execute_state):
+    """
+    The add_raiseload function is a do_orm_execute listener that adds raiseload(&quot;*&quot;) to every ORM SELECT,
+    so any relationship that is lazy loaded afterwards raises instead of silently issuing one more query per row.
+
+    :param orm_execute_state: The state of the ORM statement that is about to be executed
+    :return: None
+    :doc-author: Trelent
+    """
+    if orm_execute_state.is_select and not orm_execute_state.is_relationship_load:
+        orm_execute_state.statement = orm_execute_state.statement.options(raiseload("*"))
+
+@pytest.fixture
+def raise_on_lazy_load():
+    """
+    The raise_on_lazy_load function is a fixture that makes lazy loads fail the test while it runs,
+    which catches N+1 queries in the endpoints under test.
+
+    :return: None
+    :doc-author: Trelent
+    """
+    event.listen(TestingSessionLocal, "do_orm_execute", add_raiseload)
+    yield
+    event.remove(TestingSessionLocal, "do_orm_execute", add_raiseload)
+
+query_counter = {"selects": 0}
+
+def count_selects(connection, cursor, statement, parameters, context, executemany):
+    """
+    The count_selects function is a before_cursor_execute listener that counts the SELECT statements sent to the test database.
+    It counts raw SQL, so queries are counted even when the ORM would hide them behind its own caches.
+
+    :param connection: The connection the statement is executed on
+    :param cursor: The DBAPI cursor
+    :param statement: The SQL string about to be executed
+    :param parameters: The parameters of the statement
+    :param context: The execution context
+    :param executemany: Whether the statement is executed with executemany
+    :return: None
+    :doc-author: Trelent
+    """
+    if statement.lstrip()[:6].upper() == "SELECT":
+        query_counter["selects"] += 1
+
+@pytest.fixture
+def assert_query_count():
+    """
+    The assert_query_count function is a fixture that returns a context manager which fails the test
+    when the code inside it runs more SELECT statements than allowed, e.g. an endpoint that queries once per row.
+    The counter is shared by all threads, since the test client runs the endpoints in a worker thread.
+
+    :return: The assert_query_count context manager
+    :doc-author: Trelent
+    """
+    @contextmanager
+    def assert_query_count(max_queries):
+        before = query_counter["selects"]
+        yield
+        count = query_counter["selects"] - before
+        assert count <= max_queries, f"{count} SELECT statements were executed, expected at most {max_queries}"
+    return assert_query_count
+
+@pytest.fixture
+def freeze_today(mocker):
+    """
+    The freeze_today function is a fixture that returns a function which freezes the date crud sees as today,
+    so tests that depend on the current date give the same result whenever they run, including around midnight.
+    crud.date is replaced with a date subclass whose today() returns the frozen date; the patch is undone after the test.
+
+    :param mocker: Patch the date class used by crud
+    :return: The freeze_today function, taking the date to freeze and returning it
+    :doc-author: Trelent
+    """
+    def freeze_today(today):
+        mocker.patch("crud.date", type("FrozenDate", (date,), {"today": classmethod(lambda cls: today)}))
+        return today
+    return freeze_today
+
+@pytest.fixture(scope="session")
+def client():
+    """
+    The client function is a fixture that returns a test client shared by the whole test session.
+    The test client can be used to make requests to the API, which will be run against an in-memory SQLite database.
+    The app's OpenAPI schema is replaced with an empty one, so it is never built for the tests,
+    and the SELECT statements sent to the test database are counted for assert_query_count.
+
+    :return: A testclient instance
+    :doc-author: Trelent
+    """
+    app.openapi_schema = {"openapi": "3.1.0", "info": {"title": "test", "version": "0"}, "paths": {}}
+    event.listen(engine, "before_cursor_execute", count_selects)
+    with TestClient(app) as client:
+        yield client
+    event.remove(engine, "before_cursor_execute", count_selects)
+    app.openapi_schema = None
@@ -1,36 +1,53 @@
-import schemas
+import jwt
+import time
+from threading import Lock
 from typing import Optional
+from config import config
 from database import get_db
-from jose import JWTError, jwt
-from models import User, Contact
-from sqlalchemy.orm import Session
-from datetime import date, datetime, timedelta
+from jwt import PyJWTError
+from sqlalchemy import column, insert, select, text, update
+from models import User, Contact, birthday_key
+from cachetools import TLRUCache
+from datetime import date, timedelta
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy.orm import Session, make_transient_to_detached
 from fastapi import HTTPException, status, Depends
-from utils import get_password_hash, verify_password
+from utils import get_password_hash, verify_and_update_password
 from schemas import UserCreate, ContactCreate, ContactUpdate
 
-SECRET_KEY = "your_secret_key"
-ALGORITHM = "HS256"
+SECRET_KEY = config.SECRET_KEY_JWT
+ALGORITHM = config.ALGORITHM
+DECODE_ALGORITHMS = [ALGORITHM]
+DECODE_OPTIONS = {"require": ["sub", "exp"]}
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+ACCESS_TOKEN_EXPIRE_SECONDS = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+TOKEN_CACHE_SIZE = 4096
+TOKEN_CACHE_TTL = 60
+CLAIMS_CACHE_SIZE = 1024
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
 
+_dummy_password_hash = get_password_hash("not-a-real-password")
+_token_cache = TLRUCache(maxsize=TOKEN_CACHE_SIZE, ttu=lambda _token, entry, _now: entry[0], timer=time.time)
+_token_cache_lock = Lock()
+_claims_cache = TLRUCache(maxsize=CLAIMS_CACHE_SIZE, ttu=lambda _token, claims, _now: claims["exp"], timer=time.time)
+_claims_cache_lock = Lock()
+
 def create_user(db: Session, user: UserCreate):
     """
     The create_user function creates a new user in the database.
         Args:
             db (Session): The database session to use for this operation.
             user (UserCreate): The UserCreate object to create in the database.
+    The row is written with INSERT ... RETURNING, so no extra SELECT is needed to load its id and defaults.
 
     :param db: Session: Pass the database session to the function
     :param user: UserCreate: Create a new user in the database
     :return: A user object
     :doc-author: Trelent
     """
-    db_user = User(email=user.email, hashed_password=get_password_hash(user.password))
-    db.add(db_user)
+    stmt = insert(User).values(email=user.email, hashed_password=get_password_hash(user.password)).returning(User)
+    db_user = db.execute(stmt).scalar_one()
     db.commit()
-    db.refresh(db_user)
     return db_user
 
 def get_user(db: Session, email: str):
@@ -43,13 +60,15 @@ def get_user(db: Session, email: str):
     :return: A user object
     :doc-author: Trelent
     """
-    return db.query(User).filter(User.email == email).first()
+    return db.execute(select(User).where(User.email == email)).scalar_one_or_none()
 
 def authenticate_user(db: Session, email: str, password: str):
     """
     The authenticate_user function takes in a database session, an email address and a password.
     It then checks to see if the user exists in the database by calling get_user with the email address.
-    If no user is found, it returns False. If a user is found, it verifies that their password matches what's stored in the database using verify_password from passlib.
+    If no user is found, it returns False. If a user is found, it verifies that their password matches what's stored in the database using verify_and_update_password from passlib.
+    The password is verified against a dummy hash when the user does not exist, so both cases take the same time and do not reveal which emails are registered.
+    Hashes made with a deprecated scheme are replaced with a fresh argon2 hash on successful login.
 
     :param db: Session: Pass in the database session to the function
     :param email: str: Pass the email address of the user to be authenticated
@@ -58,10 +77,13 @@ def authenticate_user(db: Session, email: str, password: str):
     :doc-author: Trelent
     """
     user = get_user(db, email)
-    if not user:
-        return False
-    if not verify_password(password, user.hashed_password):
+    hashed_password = user.hashed_password if user else _dummy_password_hash
+    verified, new_hash = verify_and_update_password(password, hashed_password)
+    if not user or not verified:
         return False
+    if new_hash:
+        user.hashed_password = new_hash
+        db.commit()
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -75,20 +97,41 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     :return: The encoded jwt
     :doc-author: Trelent
     """
-    to_encode = data.copy()
     if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+        expires_in = int(expires_delta.total_seconds())
     else:
-        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+        expires_in = ACCESS_TOKEN_EXPIRE_SECONDS
+    to_encode = {**data, "exp": int(time.time()) + expires_in}
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def decode_access_token(token: str):
+    """
+    The decode_access_token function verifies the signature of the given jwt and returns its claims.
+    Both the sub and exp claims are required, so a successfully decoded payload always carries the user's email.
+    Verified claims are cached per token until the token's exp, so a token is only verified once for its lifetime;
+    tokens that fail verification are never cached.
+
+    :param token: str: Pass the encoded jwt
+    :return: The claims of the token
+    :doc-author: Trelent
+    """
+    with _claims_cache_lock:
+        claims = _claims_cache.get(token)
+    if claims is not None:
+        return claims
+    claims = jwt.decode(token, SECRET_KEY, algorithms=DECODE_ALGORITHMS, options=DECODE_OPTIONS)
+    with _claims_cache_lock:
+        _claims_cache[token] = claims
+    return claims
+
 def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
     """
     The get_current_user function is a dependency that will be used in the
         protected endpoints. It uses the OAuth2 authorization scheme to validate
         a user's credentials and return their information from our database.
+        Resolved users are cached per token for TOKEN_CACHE_TTL seconds (never past the token's exp),
+        so repeated requests with the same token skip both the jwt decoding and the user query.
 
     :param db: Session: Get access to the database
     :param token: str: Pass the token that is sent in the authorization header
@@ -100,29 +143,53 @@ def get_current_user(db: Session = Depends(get_db), token: str = Depends(oauth2_
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    with _token_cache_lock:
+        entry = _token_cache.get(token)
+    if entry is not None:
+        user = User(**entry[1])
+        make_transient_to_detached(user)
+        return db.merge(user, load=False)
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-        token_data = schemas.TokenData(email=email)
-    except JWTError:
+        payload = decode_access_token(token)
+    except PyJWTError:
         raise credentials_exception
-    user = get_user(db, email=token_data.email)
+    user = get_user(db, email=payload["sub"])
     if user is None:
         raise credentials_exception
+    expires_at = min(time.time() + TOKEN_CACHE_TTL, payload["exp"])
+    state = {column.key: getattr(user, column.key) for column in User.__table__.columns}
+    with _token_cache_lock:
+        _token_cache[token] = (expires_at, state)
     return user
 
-def get_current_active_user(current_user: schemas.User = Depends(get_current_user)):
+def invalidate_cached_user(email: str):
+    """
+    The invalidate_cached_user function drops every cached token that resolves to the given email,
+    so the next request with one of those tokens reloads the user from the database.
+    It is called whenever the stored user changes, e.g. after the email has been verified.
+
+    :param email: str: Specify the email of the user whose cached tokens should be dropped
+    :return: None
+    :doc-author: Trelent
+    """
+    with _token_cache_lock:
+        stale = [token for token, (_, state) in _token_cache.items() if state["email"] == email]
+        for token in stale:
+            _token_cache.pop(token, None)
+
+def get_current_active_user(db: Session = Depends(get_db), token: str = Depends(oauth2_scheme)):
     """
     The get_current_active_user function is a dependency that returns the current user,
     if they are active. If not, it raises an HTTPException with status code 400 and detail &quot;Inactive user&quot;.
+    It calls get_current_user directly instead of depending on it, so FastAPI resolves a single dependency per request.
 
 
-    :param current_user: schemas.User: Get the current user from the database
+    :param db: Session: Get access to the database
+    :param token: str: Pass the token that is sent in the authorization header
     :return: The current user, but only if the user is active
     :doc-author: Trelent
     """
+    current_user = get_current_user(db, token)
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
@@ -130,7 +197,7 @@ def get_current_active_user(current_user: schemas.User = Depends(get_current_use
 def get_contact(db: Session, contact_id: int):
     """
     The get_contact function takes in a database session and contact_id,
-    and returns the first contact found with that id.
+    and returns the contact with that id, looking in the session's identity map before querying the database.
 
 
     :param db: Session: Pass in the database session
@@ -138,7 +205,7 @@ def get_contact(db: Session, contact_id: int):
     :return: A contact object
     :doc-author: Trelent
     """
-    return db.query(Contact).filter(Contact.id == contact_id).first()
+    return db.get(Contact, contact_id)
 
 def get_contacts(db: Session, user_id: int, skip: int = 0, limit: int = 10):
     """
@@ -152,7 +219,8 @@ def get_contacts(db: Session, user_id: int, skip: int = 0, limit: int = 10):
     :return: A list of contacts
     :doc-author: Trelent
     """
-    return db.query(Contact).filter(Contact.owner_id == user_id).offset(skip).limit(limit).all()
+    stmt = select(Contact).where(Contact.owner_id == user_id).offset(skip).limit(limit)
+    return db.execute(stmt).scalars().all()
 
 def create_contact(db: Session, contact: ContactCreate, user_id: int):
     """
@@ -160,6 +228,7 @@ def create_contact(db: Session, contact: ContactCreate, user_id: int):
         Args:
             db (Session): The database session to use for creating the contact.
             contact (ContactCreate): The data of the new contact to create.
+    The row is written with INSERT ... RETURNING, so no extra SELECT is needed to load its id.
 
     :param db: Session: Pass in the database session
     :param contact: ContactCreate: Create a contact object
@@ -167,33 +236,32 @@ def create_contact(db: Session, contact: ContactCreate, user_id: int):
     :return: The newly created contact
     :doc-author: Trelent
     """
-    db_contact = Contact(**contact.dict(), owner_id=user_id)
-    db.add(db_contact)
+    stmt = insert(Contact).values(**contact.model_dump(), owner_id=user_id).returning(Contact)
+    db_contact = db.execute(stmt).scalar_one()
     db.commit()
-    db.refresh(db_contact)
     return db_contact
 
-def update_contact(db: Session, contact_id: int, contact: ContactUpdate):
+def update_contact(db: Session, contact_id: int, contact: ContactUpdate, user_id: int):
     """
     The update_contact function updates a contact in the database.
         Args:
             db (Session): The database session object.
             contact_id (int): The id of the contact to update.
             contact (ContactUpdate): A ContactUpdate object containing updated information for the specified user.
+            user_id (int): The id of the user that owns the contact.
+    The update is issued as a single UPDATE ... RETURNING statement, so the contact is neither selected beforehand nor refreshed afterwards.
 
     :param db: Session: Pass the database session to the function
     :param contact_id: int: Identify the contact to update
     :param contact: ContactUpdate: Pass in the updated contact information
-    :return: The updated contact
+    :param user_id: int: Make sure only the owner can update the contact
+    :return: The updated contact, or None if the user has no contact with that id
     :doc-author: Trelent
     """
-    db_contact = db.query(Contact).filter(Contact.id == contact_id).first()
-    if not db_contact:
-        return None
-    for key, value in contact.dict().items():
-        setattr(db_contact, key, value)
+    stmt = update(Contact).where(Contact.id == contact_id, Contact.owner_id == user_id)\
+        .values(**contact.model_dump(exclude_unset=True)).returning(Contact)
+    db_contact = db.execute(stmt).scalar_one_or_none()
     db.commit()
-    db.refresh(db_contact)
     return db_contact
 
 def delete_contact(db: Session, contact_id: int):
@@ -208,8 +276,7 @@ def delete_contact(db: Session, contact_id: int):
     :return: The contact that was deleted
     :doc-author: Trelent
     """
-    db_contact = db.query(Contact)\
-        .filter(Contact.id == contact_id).first()
+    db_contact = db.get(Contact, contact_id)
     if db_contact:
         db.delete(db_contact)
         db.commit()
@@ -220,6 +287,8 @@ def search_contacts(db: Session, query: str, user_id: int):
     The search_contacts function searches the database for contacts that match a given query.
     The function takes in a database session, the search query, and an owner_id to filter by.
     It returns all contacts that match the search criteria.
+    On SQLite queries of three or more characters are answered from the contacts_fts trigram index,
+    shorter queries (and other databases, where pg_trgm indexes back the LIKE scan) fall back to substring matching.
 
     :param db: Session: Pass the database session to the function
     :param query: str: Filter the contacts by a search query
@@ -227,15 +296,22 @@ def search_contacts(db: Session, query: str, user_id: int):
     :return: A list of contact objects
     :doc-author: Trelent
     """
-    return db.query(Contact).filter(Contact.owner_id == user_id).filter(
+    if db.get_bind().dialect.name == "sqlite" and len(query) >= 3:
+        matches = text("SELECT rowid FROM contacts_fts WHERE contacts_fts MATCH :match")\
+            .bindparams(match='"' + query.replace('"', '""') + '"').columns(column("rowid"))
+        stmt = select(Contact).where(Contact.owner_id == user_id, Contact.id.in_(matches))
+        return db.execute(stmt).scalars().all()
+    stmt = select(Contact).where(Contact.owner_id == user_id).where(
         (Contact.first_name.contains(query)) |
         (Contact.last_name.contains(query)) |
         (Contact.email.contains(query))
-    ).all()
+    )
+    return db.execute(stmt).scalars().all()
 
 def get_upcoming_birthdays(db: Session, user_id: int):
     """
     The get_upcoming_birthdays function returns a list of contacts whose birthdays are within the next week.
+    Birthdays are compared by month and day only, so the year of birth does not matter and the week may wrap into January.
 
     :param db: Session: Pass the database session to the function
     :param user_id: int: Filter the contacts by owner_id
@@ -244,5 +320,11 @@ def get_upcoming_birthdays(db: Session, user_id: int):
     """
     today = date.today()
     next_week = today + timedelta(days=7)
-    return db.query(Contact).filter(Contact.owner_id == user_id).\
-        filter(Contact.birthday.between(today, next_week)).all()
\ No newline at end of file
+    start = today.month * 100 + today.day
+    end = next_week.month * 100 + next_week.day
+    if start <= end:
+        in_range = birthday_key.between(start, end)
+    else:
+        in_range = (birthday_key >= start) | (birthday_key <= end)
+    stmt = select(Contact).where(Contact.owner_id == user_id, in_range)
+    return db.execute(stmt).scalars().all()
\ No newline at end of file
@@ -1,14 +1,43 @@
 from config import config
-from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool, StaticPool
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 
 SQLALCHEMY_DATABASE_URL = config.SQLALCHEMY_DATABASE_URL
+IN_MEMORY_DATABASE_URLS = ("sqlite://", "sqlite:///:memory:")
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+if SQLALCHEMY_DATABASE_URL in IN_MEMORY_DATABASE_URLS:
+    pool_options = {"poolclass": StaticPool}
+else:
+    # Requests reuse warm connections from the pool; SQLite still serializes writers.
+    pool_options = {"poolclass": QueuePool, "pool_size": config.DB_POOL_SIZE, "max_overflow": config.DB_MAX_OVERFLOW}
+
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}, future=True, **pool_options)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 Base = declarative_base()
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    The set_sqlite_pragmas function is a connect event listener that tunes every new SQLite connection.
+    It switches the journal to WAL with synchronous=NORMAL, so commits no longer fsync the database file,
+    and keeps a bigger page cache and temporary tables in memory.
+
+    :param dbapi_connection: Pass the raw sqlite3 connection that has just been opened
+    :param connection_record: Pass the pool record of the connection
+    :return: None
+    :doc-author: Trelent
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-20000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", set_sqlite_pragmas)
+
 def get_db():
     """
     The get_db function is a context manager that returns the database session.
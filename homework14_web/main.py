@@ -1,27 +1,51 @@
 import crud
 import schemas
 import cloudinary
+from anyio import to_thread
 from config import config
 import cloudinary.uploader
-from slowapi import Limiter
 from sqlalchemy.orm import Session
 from auth import router as auth_router
+from contextlib import asynccontextmanager
 from database import engine, Base, get_db
+from models import create_missing_indexes, create_search_indexes
 from slowapi.util import get_remote_address
 from slowapi.middleware import SlowAPIMiddleware
-from fastapi.security import OAuth2PasswordBearer
+from slowapi.errors import RateLimitExceeded
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, Depends, HTTPException, File, UploadFile, status
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from pydantic import TypeAdapter
+from fastapi import FastAPI, Depends, HTTPException, File, UploadFile, Response, status
 
-limiter = Limiter(key_func=get_remote_address)
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    The lifespan function creates the database tables once the application starts serving,
+    instead of on every import of this module (e.g. by tests, tooling or reloading workers).
+    The missing model indexes and the contact search indexes are created next, also on a database whose tables already exist.
+    It also raises the threadpool that runs the sync endpoints to the size of the database pool (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+    when that is above anyio's default of 40 threads, so every connection can serve a request; the limit is never lowered.
 
-app.add_middleware(SlowAPIMiddleware)
+    :param app: FastAPI: The application that is starting up
+    :return: An async context manager that runs for the lifetime of the application
+    :doc-author: Trelent
+    """
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        create_missing_indexes(connection)
+        create_search_indexes(connection)
+    limiter = to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(limiter.total_tokens, config.DB_POOL_SIZE + config.DB_MAX_OVERFLOW)
+    yield
 
-Base.metadata.create_all(bind=engine)
+AVATAR_UPLOAD_CHUNK_SIZE = 6_000_000
 
-app = FastAPI()
+limiter = Limiter(key_func=get_remote_address)
+app = FastAPI(lifespan=lifespan)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
+app.add_middleware(SlowAPIMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -36,17 +60,31 @@ cloudinary.config(
   api_secret=config.CLOUDINARY_API_SECRET
 )
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/token")
-
 app.include_router(auth_router, prefix="/auth", tags=["auth"])
 
+CONTACTS_ADAPTER = TypeAdapter(list[schemas.Contact])
+CONTACTS_RESPONSES = {200: {"model": list[schemas.Contact]}}
+
+def contacts_response(contacts):
+    """
+    The contacts_response function serializes a list of contacts loaded from the database straight to JSON.
+    The rows are trusted, so they are not validated through schemas.Contact one by one as a response_model would;
+    the endpoints that use it set response_model=None and document the schema through CONTACTS_RESPONSES instead.
+
+    :param contacts: A list of contact objects
+    :return: A JSON response with the fields of schemas.Contact for every contact
+    :doc-author: Trelent
+    """
+    return Response(CONTACTS_ADAPTER.dump_json(contacts), media_type="application/json")
+
 @app.post("/upload-avatar/", response_model=schemas.User)
 def upload_avatar(file: UploadFile, db: Session = Depends(get_db),
                   current_user: schemas.User = Depends(crud.get_current_active_user)):
     """
     The upload_avatar function uploads a user's avatar to the cloudinary server.
     It takes in an UploadFile object, which is a file that has been uploaded by the client.
-    The function then uses Cloudinary's Python SDK to upload the image and return its URL.
+    The function then uses Cloudinary's Python SDK to upload the image in chunks of AVATAR_UPLOAD_CHUNK_SIZE bytes and return its URL,
+    so only one chunk of the file is held in memory at a time. Being a sync endpoint, it runs in the threadpool and does not block the event loop.
     Finally, it updates the current_user with their new avatar URL.
 
     :param file: UploadFile: Get the file from the request
@@ -55,7 +93,8 @@ def upload_avatar(file: UploadFile, db: Session = Depends(get_db),
     :return: The current user
     :doc-author: Trelent
     """
-    result = cloudinary.uploader.upload(file.file, folder="avatars/")
+    result = cloudinary.uploader.upload_large(file.file, folder="avatars/", filename=file.filename,
+                                              chunk_size=AVATAR_UPLOAD_CHUNK_SIZE)
     current_user.avatar_url = result["secure_url"]
     db.commit()
     return current_user
@@ -74,7 +113,7 @@ def create_contact(contact: schemas.ContactCreate, db: Session = Depends(get_db)
     """
     return crud.create_contact(db=db, contact=contact, user_id=current_user.id)
 
-@app.get("/contacts/", response_model=list[schemas.Contact])
+@app.get("/contacts/", response_model=None, responses=CONTACTS_RESPONSES)
 def read_contacts(skip: int = 0, limit: int = 10, db: Session = Depends(get_db),
                   current_user: schemas.User = Depends(crud.get_current_active_user)):
 
@@ -88,7 +127,7 @@ def read_contacts(skip: int = 0, limit: int = 10, db: Session = Depends(get_db),
     :return: A list of contacts (schemas
     :doc-author: Trelent
     """
-    return crud.get_contacts(db, skip=skip, limit=limit, user_id=current_user.id)
+    return contacts_response(crud.get_contacts(db, skip=skip, limit=limit, user_id=current_user.id))
 
 @app.get("/contacts/{contact_id}", response_model=schemas.Contact)
 def read_contact(contact_id: int, db: Session = Depends(get_db),
@@ -114,9 +153,8 @@ def update_contact(contact_id: int, contact: schemas.ContactUpdate,
                    db: Session = Depends(get_db), current_user: schemas.User = Depends(crud.get_current_active_user)):
     """
     The update_contact function takes in a contact_id and a ContactUpdate object,
-    and returns the updated contact. The function first checks if the user is authorized to update this contact,
-    by checking if they are the owner of it. If not, an HTTPException is raised with status code 404 (Not Found).
-    If so, then crud.update_contact() is called.
+    and returns the updated contact. crud.update_contact() only updates the contact if the current user owns it.
+    If no such contact exists, an HTTPException is raised with status code 404 (Not Found).
 
     :param contact_id: int: Specify the contact to update
     :param contact: schemas.ContactUpdate: Pass the contact data to be updated
@@ -125,10 +163,10 @@ def update_contact(contact_id: int, contact: schemas.ContactUpdate,
     :return: The updated contact
     :doc-author: Trelent
     """
-    db_contact = crud.get_contact(db, contact_id=contact_id)
-    if db_contact is None or db_contact.owner_id != current_user.id:
+    db_contact = crud.update_contact(db=db, contact_id=contact_id, contact=contact, user_id=current_user.id)
+    if db_contact is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Contact not found")
-    return crud.update_contact(db=db, contact_id=contact_id, contact=contact)
+    return db_contact
 
 @app.delete("/contacts/{contact_id}", response_model=schemas.Contact)
 def delete_contact(contact_id: int, db: Session = Depends(get_db),
@@ -144,12 +182,12 @@ def delete_contact(contact_id: int, db: Session = Depends(get_db),
     :return: A contact object
     :doc-author: Trelent
     """
-    db_contact = crud.delete_contact(db, contact_id=contact_id)
+    db_contact = crud.get_contact(db, contact_id=contact_id)
     if db_contact is None or db_contact.owner_id != current_user.id:
         raise HTTPException(status_code=404, detail="Contact not found")
-    return db_contact
+    return crud.delete_contact(db, contact_id=contact_id)
 
-@app.get("/contacts/search/", response_model=list[schemas.Contact])
+@app.get("/contacts/search/", response_model=None, responses=CONTACTS_RESPONSES)
 def search_contacts(query: str, db: Session = Depends(get_db),
                     current_user: schemas.User = Depends(crud.get_current_active_user)):
     """
@@ -163,9 +201,9 @@ def search_contacts(query: str, db: Session = Depends(get_db),
     :return: A list of contacts
     :doc-author: Trelent
     """
-    return crud.search_contacts(db, query=query, user_id=current_user.id)
+    return contacts_response(crud.search_contacts(db, query=query, user_id=current_user.id))
 
-@app.get("/contacts/upcoming_birthdays/", response_model=list[schemas.Contact])
+@app.get("/contacts/upcoming_birthdays/", response_model=None, responses=CONTACTS_RESPONSES)
 def get_upcoming_birthdays(db: Session = Depends(get_db),
                            current_user: schemas.User = Depends(crud.get_current_active_user)):
     """
@@ -178,4 +216,4 @@ def get_upcoming_birthdays(db: Session = Depends(get_db),
     :return: A list of the upcoming birthdays for a user
     :doc-author: Trelent
     """
-    return crud.get_upcoming_birthdays(db, user_id=current_user.id)
\ No newline at end of file
+    return contacts_response(crud.get_upcoming_birthdays(db, user_id=current_user.id))
\ No newline at end of file
@@ -1,6 +1,7 @@
 from database import Base
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, Integer, String, Date, ForeignKey, Boolean
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy import Column, Integer, String, Date, ForeignKey, Boolean, Index, DDL, event, extract, text, literal_column
 
 class User(Base):
     __tablename__ = "users"
@@ -19,5 +20,69 @@ class Contact(Base):
     phone_number = Column(String, index=True)
     birthday = Column(Date)
     additional_info = Column(String, nullable=True)
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
     owner = relationship("User", back_populates="contacts")
+
+birthday_key = extract("month", Contact.birthday) * literal_column("100") + extract("day", Contact.birthday)
+Index("ix_contacts_owner_id_birthday_key", Contact.owner_id, birthday_key)
+
+contacts_fts_ddl = [
+    DDL("CREATE VIRTUAL TABLE IF NOT EXISTS contacts_fts USING fts5("
+        "first_name, last_name, email, content='contacts', content_rowid='id', tokenize='trigram')"),
+    DDL("CREATE TRIGGER IF NOT EXISTS contacts_fts_insert AFTER INSERT ON contacts BEGIN "
+        "INSERT INTO contacts_fts(rowid, first_name, last_name, email) "
+        "VALUES (new.id, new.first_name, new.last_name, new.email); END"),
+    DDL("CREATE TRIGGER IF NOT EXISTS contacts_fts_delete AFTER DELETE ON contacts BEGIN "
+        "INSERT INTO contacts_fts(contacts_fts, rowid, first_name, last_name, email) "
+        "VALUES ('delete', old.id, old.first_name, old.last_name, old.email); END"),
+    DDL("CREATE TRIGGER IF NOT EXISTS contacts_fts_update AFTER UPDATE ON contacts BEGIN "
+        "INSERT INTO contacts_fts(contacts_fts, rowid, first_name, last_name, email) "
+        "VALUES ('delete', old.id, old.first_name, old.last_name, old.email); "
+        "INSERT INTO contacts_fts(rowid, first_name, last_name, email) "
+        "VALUES (new.id, new.first_name, new.last_name, new.email); END"),
+]
+contacts_trgm_ddl = [
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_contacts_first_name_trgm ON contacts USING gin (first_name gin_trgm_ops)"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_contacts_last_name_trgm ON contacts USING gin (last_name gin_trgm_ops)"),
+    DDL("CREATE INDEX IF NOT EXISTS ix_contacts_email_trgm ON contacts USING gin (email gin_trgm_ops)"),
+]
+event.listen(Contact.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS contacts_fts").execute_if(dialect="sqlite"))
+
+def create_search_indexes(connection):
+    """
+    The create_search_indexes function creates the indexes behind search_contacts if they do not exist yet:
+    the contacts_fts trigram table and its triggers on SQLite, the pg_trgm indexes on PostgreSQL.
+    It runs on every startup rather than with the contacts table, so databases created before the indexes existed get them too.
+    When contacts_fts is new it is rebuilt from the contacts already in the database.
+
+    :param connection: The connection to create the indexes on
+    :return: None
+    :doc-author: Trelent
+    """
+    if connection.dialect.name == "sqlite":
+        fts_exists = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'contacts_fts'")).first()
+        for ddl in contacts_fts_ddl:
+            connection.execute(ddl)
+        if not fts_exists:
+            connection.execute(text("INSERT INTO contacts_fts(contacts_fts) VALUES ('rebuild')"))
+    elif connection.dialect.name == "postgresql":
+        for ddl in contacts_trgm_ddl:
+            connection.execute(ddl)
+
+def create_missing_indexes(connection):
+    """
+    The create_missing_indexes function creates every index declared on the models that the database does not have yet.
+    create_all only emits indexes together with a new table, so a database whose tables already exist
+    would otherwise never get indexes added to the models later, such as ix_contacts_owner_id.
+    CREATE INDEX IF NOT EXISTS is used because SQLite does not report expression indexes to checkfirst.
+
+    :param connection: The connection to create the indexes on
+    :return: None
+    :doc-author: Trelent
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            connection.execute(CreateIndex(index, if_not_exists=True))
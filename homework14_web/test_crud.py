@@ -1,225 +1,383 @@
+import crud
+import pytest
 import schemas
-import unittest
-from jose import jwt
+from jwt import PyJWTError
 from models import User, Contact
-from sqlalchemy.orm import Session
-from unittest.mock import MagicMock, patch
-from datetime import datetime, timedelta, date
+from datetime import timedelta, date
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+from passlib.context import CryptContext
 from crud import (create_user, get_user, authenticate_user, create_access_token,
                   get_current_user, get_contact, get_contacts, create_contact,
                   update_contact, delete_contact, search_contacts, get_upcoming_birthdays)
 
-class TestUserManagement(unittest.TestCase):
-    def setUp(self):
-        """
-        The setUp function is called before each test function.
-        It creates a mock database object, and a user_data object that will be used to create the user.
-        The user is created with an email address and hashed password, which are then stored in the db.
-
-        :param self: Represent the instance of the object that is using the method
-        :return: An instance of the user model, with email and hashed_password attributes
-        :doc-author: Trelent
-        """
-        self.db = MagicMock(spec=Session)
-        self.user_data = schemas.UserCreate(email="test@example.com", password="password123")
-        self.user = User(email=self.user_data.email, hashed_password="hashed_password")
-        self.user.is_active = True
-
-    def test_create_user(self):
-        """
-        The test_create_user function tests the create_user function in the user.py file.
-        It does this by mocking out all of the functions that are called within create_user, and then
-        checking to see if they were called correctly.
-
-        :param self: Represent the instance of the class
-        :return: The user object
-        :doc-author: Trelent
-        """
-        self.db.query(User).filter().first.return_value = None
-        self.db.add.return_value = None
-        self.db.commit.return_value = None
-        self.db.refresh.return_value = None
-        result = create_user(self.db, self.user_data)
-        self.assertEqual(result.email, self.user_data.email)
-        self.db.add.assert_called_once()
-        self.db.commit.assert_called_once()
-        self.db.refresh.assert_called_once()
-
-    def test_get_user(self):
-        """
-        The test_get_user function tests the get_user function.
-        It does this by mocking out the database and returning a user object when queried.
-        The test then asserts that the result of calling get_user is equal to our mocked user.
-
-        :param self: Refer to the instance of the class
-        :return: The user
-        :doc-author: Trelent
-        """
-        self.db.query(User).filter().first.return_value = self.user
-
-        result = get_user(self.db, self.user.email)
-        self.assertEqual(result, self.user)
-
-    def test_create_access_token(self):
-        """
-        The test_create_access_token function tests the create_access_token function in the auth.py file.
-        The test creates a user and then uses that user's email to generate an access token using the
-        create_access_token function from auth.py, which is imported at the top of this file.
-
-        :param self: Represent the instance of the class
-        :return: A token that is a string
-        :doc-author: Trelent
-        """
-        data = {"sub": self.user.email}
-        token = create_access_token(data)
-        self.assertTrue(isinstance(token, str))
-
-    def test_get_current_user(self):
-        """
-        The test_get_current_user function tests the get_current_user function.
-        It does this by creating a token, setting the return value of self.db.query(User).filter().first to be self.user,
-        and then patching jose's decode method to return {&quot;sub&quot;: self.user}.email (which is &quot;test@example&quot;).
-        The result should be that get_current_user returns our user.
-
-        :param self: Access the class attributes and methods
-        :return: The user
-        :doc-author: Trelent
-        """
-        token = create_access_token({"sub": self.user.email})
-        self.db.query(User).filter().first.return_value = self.user
-        with patch("jose.jwt.decode", return_value={"sub": self.user.email}):
-            result = get_current_user(self.db, token)
-            self.assertEqual(result, self.user)
-
-    def test_get_contact(self):
-        """
-        The test_get_contact function tests the get_contact function.
-        It does this by creating a mock database object, and then setting up that mock to return a Contact object when it is queried.
-        The test then calls the get_contact function with the mocked database and an id of 1, which should return that Contact object.
-
-        :param self: Access the instance of the class
-        :return: The contact object
-        :doc-author: Trelent
-        """
-        contact_id = 1
-        contact = Contact(id=contact_id, first_name="John", last_name="Doe", owner_id=1)
-        self.db.query(Contact).filter().first.return_value = contact
-        result = get_contact(self.db, contact_id)
-        self.assertEqual(result, contact)
-
-    def test_get_contacts(self):
-        """
-        The test_get_contacts function tests the get_contacts function.
-        It does this by creating a mock database object, and then setting up that mock to return a list of contacts when it is queried.
-        The test then calls the get_contacts function with the mocked database object as an argument, and asserts that it returns what was set up in the mock.
-
-        :param self: Represent the instance of the class
-        :return: The contacts
-        :doc-author: Trelent
-        """
-        user_id = 1
-        contacts = [Contact(id=1, first_name="John", last_name="Doe", owner_id=user_id)]
-        self.db.query(Contact).filter().offset().limit().all.return_value = contacts
-
-        result = get_contacts(self.db, user_id)
-        self.assertEqual(result, contacts)
-
-    def test_create_contact(self):
-        """
-        The test_create_contact function tests the create_contact function in crud.py.
-        It creates a contact object with the given data and adds it to the database, then commits it and refreshes it.
-
-        :param self: Represent the instance of the class
-        :return: The first_name of the contact_data
-        :doc-author: Trelent
-        """
-        user_id = 1
-        contact_data = schemas.ContactCreate(first_name="John", last_name="Doe", email="john.doe@example.com", phone_number='0000000000', birthday='2000-12-01')
-        contact = Contact(id=1, **contact_data.dict(), owner_id=user_id)
-        self.db.add.return_value = None
-        self.db.commit.return_value = None
-        self.db.refresh.return_value = contact
-        result = create_contact(self.db, contact_data, user_id)
-        self.assertEqual(result.first_name, contact_data.first_name)
-        self.db.add.assert_called_once()
-        self.db.commit.assert_called_once()
-        self.db.refresh.assert_called_once()
-
-    def test_update_contact(self):
-        """
-        The test_update_contact function tests the update_contact function in crud.py.
-        It creates a contact object and assigns it to the variable 'contact'. It then calls
-        the update_contact function with the parameters of db, contact_id, and contact data.
-        The result is compared to what was expected (in this case, that first name should be Jane).
-        If they are equal, then we know that our test passed.
-
-        :param self: Represent the instance of the class
-        :return: The contact_data
-        :doc-author: Trelent
-        """
-        contact_id = 1
-        contact_data = schemas.ContactUpdate(first_name="Jane", last_name='Doe', email="", phone_number="0000000000", birthday='2023-12-01')
-        contact = Contact(id=contact_id, first_name="John", last_name="Doe", owner_id=1)
-        self.db.query(Contact).filter().first.return_value = contact
-        result = update_contact(self.db, contact_id, contact_data)
-        self.assertEqual(result.first_name, contact_data.first_name)
-        self.db.commit.assert_called_once()
-        self.db.refresh.assert_called_once()
-
-    def test_delete_contact(self):
-        """
-        The test_delete_contact function tests the delete_contact function.
-        It does this by creating a mock contact object and setting it as the return value of query().first()
-        Then, it calls delete_contact with that mock database and contact id. It asserts that the result is equal to our mocked contact object,
-        and then asserts that db.delete() was called once with our mocked contact object.
-
-        :param self: Represent the instance of the class
-        :return: The contact that was deleted
-        :doc-author: Trelent
-        """
-        contact_id = 1
-        contact = Contact(id=contact_id, first_name="John", last_name="Doe", owner_id=1)
-        self.db.query(Contact).filter().first.return_value = contact
-        result = delete_contact(self.db, contact_id)
-        self.assertEqual(result, contact)
-        self.db.delete.assert_called_once_with(contact)
-        self.db.commit.assert_called_once()
-
-    def test_search_contacts(self):
-        """
-        The test_search_contacts function tests the search_contacts function.
-        It does this by creating a mock database object, and then setting up that mock to return a list of contacts when it is queried.
-        The test then calls the search_contacts function with the query &quot;John&quot; and user id 1, which should return all contacts whose first name is John.
-
-        :param self: Represent the instance of the class
-        :return: The contacts list
-        :doc-author: Trelent
-        """
-        user_id = 1
-        query = "Dexter"
-        contacts = [Contact(id=1, first_name="Dexter", last_name="Morgan", owner_id=user_id)]
-        self.db.query(Contact).filter().filter().all.return_value = contacts
-        result = search_contacts(self.db, query, user_id)
-        self.assertEqual(result, contacts)
-
-    def test_get_upcoming_birthdays(self):
-        """
-        The test_get_upcoming_birthdays function tests the get_upcoming_birthdays function.
-        It does this by creating a mock database object, and then setting up some test data to be returned from that mock database.
-        The test data is a list of Contact objects with an id of 1, first name &quot;John&quot;, last name &quot;Doe&quot;, birthday 3 days from today, and owner id 1.
-        Then it calls the get_upcoming_birthdays function with the mock db object and user id 1 as arguments. It asserts that result is equal to contacts.
-
-        :param self: Represent the instance of the object that is passed to a method when it is called
-        :return: The contacts list
-        :doc-author: Trelent
-        """
-        user_id = 1
-        today = date.today()
-        next_week = today + timedelta(days=7)
-        contacts = [Contact(id=1, first_name="Dexter", last_name="Morgan", birthday=today + timedelta(days=3), owner_id=user_id)]
-        self.db.query(Contact).filter().filter().all.return_value = contacts
-        result = get_upcoming_birthdays(self.db, user_id)
-        self.assertEqual(result, contacts)
-
-if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+SESSION_METHODS = ["execute", "get", "merge", "delete", "commit", "refresh", "get_bind"]
+
+USER_CREATE = schemas.UserCreate(email="test@example.com", password="password123")
+ACCESS_TOKEN = create_access_token({"sub": USER_CREATE.email})
+
+CONTACT_CREATE = schemas.ContactCreate(first_name="John", last_name="Doe", email="john.doe@example.com", phone_number='0000000000', birthday='2000-12-01')
+CONTACT_CREATE_FIELDS = CONTACT_CREATE.model_dump()
+CONTACT_UPDATE = schemas.ContactUpdate(first_name="Jane", last_name='Doe', email="", phone_number="0000000000", birthday='2023-12-01')
+CONTACT_UPDATE_FIELDS = CONTACT_UPDATE.model_dump(exclude_unset=True)
+
+TODAY = date(2024, 6, 1)
+UPCOMING_BIRTHDAY = TODAY + timedelta(days=3)
+
+def stub_session(row=None, rows=None):
+    """
+    The stub_session function builds a plain SimpleNamespace stand-in for a database session, for tests that only read
+    what a crud function returns and never assert on the calls made to the session.
+    db.execute() returns a result whose scalar_one_or_none() gives row and whose scalars().all() gives rows,
+    and db.get() returns row.
+
+    :param row: The single object the session returns
+    :param rows: The list of objects the session returns
+    :return: A stub of the database session
+    :doc-author: Trelent
+    """
+    result = SimpleNamespace(scalar_one_or_none=lambda: row, scalars=lambda: SimpleNamespace(all=lambda: rows))
+    return SimpleNamespace(execute=lambda stmt: result, get=lambda model, ident: row,
+                           get_bind=lambda: SimpleNamespace(dialect=SimpleNamespace(name="sqlite")))
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """
+    The clear_caches function is a fixture that empties the token and claims caches of crud around each test,
+    so users and claims cached with a mocked database or a patched jwt.decode do not leak into other tests.
+
+    :return: None
+    :doc-author: Trelent
+    """
+    crud._token_cache.clear()
+    crud._claims_cache.clear()
+    yield
+    crud._token_cache.clear()
+    crud._claims_cache.clear()
+
+@pytest.fixture
+def db():
+    """
+    The db function is a fixture that creates a mock database session.
+    The mock is limited to the session methods crud uses, which is much cheaper than a spec introspecting the whole Session class.
+
+    :return: A mock of the database session
+    :doc-author: Trelent
+    """
+    return MagicMock(spec_set=SESSION_METHODS)
+
+@pytest.fixture
+def result(db):
+    """
+    The result function is a fixture that returns the mocked result of db.execute(),
+    so tests only set the return values of its methods.
+
+    :param db: The mock database session
+    :return: The mocked result of db.execute()
+    :doc-author: Trelent
+    """
+    return db.execute.return_value
+
+@pytest.fixture
+def user_data():
+    """
+    The user_data function is a fixture that returns the data used to create the test user.
+    The UserCreate object is validated once at import and shared, since no test modifies it.
+
+    :return: A UserCreate object with an email address and a password
+    :doc-author: Trelent
+    """
+    return USER_CREATE
+
+@pytest.fixture
+def user(user_data):
+    """
+    The user function is a fixture that returns an active user with the email of user_data and a hashed password.
+
+    :param user_data: The data used to create the test user
+    :return: An instance of the user model, with email and hashed_password attributes
+    :doc-author: Trelent
+    """
+    user = User(email=user_data.email, hashed_password="hashed_password")
+    user.is_active = True
+    return user
+
+@pytest.fixture
+def existing_contact():
+    """
+    The existing_contact function is a fixture that returns the contact with id 1 owned by the user with id 1,
+    built from the shared CONTACT_CREATE payload.
+
+    :return: A contact object
+    :doc-author: Trelent
+    """
+    return Contact(id=1, **CONTACT_CREATE_FIELDS, owner_id=1)
+
+@pytest.fixture
+def db_with_contact(db, result, existing_contact):
+    """
+    The db_with_contact function is a fixture that returns the mock database session wired to return existing_contact
+    from db.get() and from the INSERT/UPDATE ... RETURNING statements executed through it.
+
+    :param db: The mock database session
+    :param result: The mocked result of db.execute()
+    :param existing_contact: The contact returned by the session
+    :return: The mock database session
+    :doc-author: Trelent
+    """
+    db.get.return_value = existing_contact
+    result.scalar_one.return_value = existing_contact
+    result.scalar_one_or_none.return_value = existing_contact
+    return db
+
+def test_create_user(db, result, user_data, user):
+    """
+    The test_create_user function tests the create_user function in the user.py file.
+    It does this by mocking out all of the functions that are called within create_user, and then
+    checking to see if they were called correctly.
+
+    :param db: The mock database session
+    :param result: The mocked result of db.execute()
+    :param user_data: The data used to create the test user
+    :param user: The user returned by the mocked INSERT
+    :return: The user object
+    :doc-author: Trelent
+    """
+    result.scalar_one.return_value = user
+    db.commit.return_value = None
+    created = create_user(db, user_data)
+    assert created.email == user_data.email
+    db.execute.assert_called_once()
+    db.commit.assert_called_once()
+    db.refresh.assert_not_called()
+
+def test_get_user(user):
+    """
+    The test_get_user function tests the get_user function.
+    It does this by mocking out the database and returning a user object when queried.
+    The test then asserts that the result of calling get_user is equal to our mocked user.
+
+    :param user: The user returned by the stubbed query
+    :return: The user
+    :doc-author: Trelent
+    """
+    assert get_user(stub_session(row=user), user.email) == user
+
+def test_authenticate_user_rehashes_bcrypt(db, result, user_data, user):
+    """
+    The test_authenticate_user_rehashes_bcrypt function tests that authenticate_user upgrades legacy bcrypt hashes.
+    The user is stored with a bcrypt hash of the password, and after a successful login
+    the hash must be replaced with an argon2 one and committed to the database.
+
+    :param db: The mock database session
+    :param result: The mocked result of db.execute()
+    :param user_data: The data used to create the test user
+    :param user: The user returned by the mocked query
+    :return: The authenticated user
+    :doc-author: Trelent
+    """
+    user.hashed_password = CryptContext(schemes=["bcrypt"]).hash(user_data.password)
+    result.scalar_one_or_none.return_value = user
+    assert authenticate_user(db, user.email, user_data.password) == user
+    assert user.hashed_password.startswith("$argon2")
+    db.commit.assert_called_once()
+
+def test_authenticate_user_unknown_email(mocker, user_data):
+    """
+    The test_authenticate_user_unknown_email function tests authenticate_user with an email that is not registered.
+    The password must still be verified (against the dummy hash) so the response time does not reveal
+    whether the email exists, and the function must return False even if that verification succeeded.
+
+    :param mocker: Patch the password verification
+    :param user_data: The data used to create the test user
+    :return: False
+    :doc-author: Trelent
+    """
+    verify = mocker.patch("crud.verify_and_update_password", return_value=(True, None))
+    assert authenticate_user(stub_session(), "unknown@example.com", user_data.password) is False
+    verify.assert_called_once_with(user_data.password, crud._dummy_password_hash)
+
+def test_create_access_token():
+    """
+    The test_create_access_token function tests the create_access_token function in the auth.py file.
+    The module signs ACCESS_TOKEN for the test user's email once at import, using the
+    create_access_token function from auth.py, and the test checks that it is a string.
+
+    :return: A token that is a string
+    :doc-author: Trelent
+    """
+    assert isinstance(ACCESS_TOKEN, str)
+
+def test_get_current_user(mocker, user):
+    """
+    The test_get_current_user function tests the get_current_user function.
+    It does this by using the module's token, setting the return value of db.execute().scalar_one_or_none to be the user,
+    and then patching PyJWT's decode method to return {&quot;sub&quot;: user.email} (which is &quot;test@example&quot;).
+    The result should be that get_current_user returns our user.
+
+    :param mocker: Patch PyJWT's decode method
+    :param user: The user returned by the stubbed query
+    :return: The user
+    :doc-author: Trelent
+    """
+    mocker.patch("jwt.decode", return_value={"sub": user.email, "exp": 2 ** 31})
+    assert get_current_user(stub_session(row=user), ACCESS_TOKEN) == user
+
+def test_get_current_user_cached(mocker, db, result, user):
+    """
+    The test_get_current_user_cached function tests that get_current_user caches the resolved user per token.
+    The first call decodes the token and queries the database, the second call with the same token
+    must neither decode the token again nor query the database, and returns the user merged into the session.
+
+    :param mocker: Patch PyJWT's decode method
+    :param db: The mock database session
+    :param result: The mocked result of db.execute()
+    :param user: The user returned by the mocked query
+    :return: The merged user
+    :doc-author: Trelent
+    """
+    user.id = 1
+    result.scalar_one_or_none.return_value = user
+    db.merge.side_effect = lambda merged, load: merged
+    first = get_current_user(db, ACCESS_TOKEN)
+    decode = mocker.patch("jwt.decode")
+    second = get_current_user(db, ACCESS_TOKEN)
+    decode.assert_not_called()
+    assert first == user
+    assert second.id == user.id
+    assert second.email == user.email
+    db.execute.assert_called_once()
+
+def test_decode_access_token_cached(mocker):
+    """
+    The test_decode_access_token_cached function tests that decode_access_token verifies each token only once.
+    A valid token is decoded twice and jwt.decode must only run for the first call,
+    while a token with a bad signature must raise on every call and never end up in the cache.
+
+    :param mocker: Patch PyJWT's decode method
+    :return: The cached claims
+    :doc-author: Trelent
+    """
+    first = crud.decode_access_token(ACCESS_TOKEN)
+    decode = mocker.patch("jwt.decode")
+    second = crud.decode_access_token(ACCESS_TOKEN)
+    decode.assert_not_called()
+    mocker.stop(decode)
+    assert first == second
+    assert second["sub"] == USER_CREATE.email
+    forged = ACCESS_TOKEN[:-2] + ("AA" if not ACCESS_TOKEN.endswith("AA") else "BB")
+    for _ in range(2):
+        with pytest.raises(PyJWTError):
+            crud.decode_access_token(forged)
+    assert forged not in crud._claims_cache
+
+def test_get_contact(existing_contact):
+    """
+    The test_get_contact function tests the get_contact function.
+    It does this by creating a mock database object, and then setting up that mock to return a Contact object when it is queried.
+    The test then calls the get_contact function with the mocked database and an id of 1, which should return that Contact object.
+
+    :param existing_contact: The contact returned by the stubbed session
+    :return: The contact object
+    :doc-author: Trelent
+    """
+    assert get_contact(stub_session(row=existing_contact), existing_contact.id) == existing_contact
+
+def test_get_contacts():
+    """
+    The test_get_contacts function tests the get_contacts function.
+    It does this by creating a mock database object, and then setting up that mock to return a list of contacts when it is queried.
+    The test then calls the get_contacts function with the mocked database object as an argument, and asserts that it returns what was set up in the mock.
+
+    :return: The contacts
+    :doc-author: Trelent
+    """
+    user_id = 1
+    contacts = [Contact(id=1, first_name="John", last_name="Doe", owner_id=user_id)]
+    assert get_contacts(stub_session(rows=contacts), user_id) == contacts
+
+def test_create_contact(db_with_contact):
+    """
+    The test_create_contact function tests the create_contact function in crud.py.
+    It creates a contact object with the given data and inserts it into the database, then commits it without refreshing it.
+
+    :param db_with_contact: The mock database session returning the inserted contact
+    :return: The first_name of the contact_data
+    :doc-author: Trelent
+    """
+    db = db_with_contact
+    created = create_contact(db, CONTACT_CREATE, 1)
+    assert created.first_name == CONTACT_CREATE.first_name
+    db.execute.assert_called_once()
+    db.commit.assert_called_once()
+    db.refresh.assert_not_called()
+
+def test_update_contact(db_with_contact, existing_contact):
+    """
+    The test_update_contact function tests the update_contact function in crud.py.
+    It calls update_contact with the mock database, the contact's id, the update data and the owner's id,
+    and checks the UPDATE ... RETURNING statement it executes: it must set the fields of the update data
+    and only match the contact with that id owned by that user. The row returned by the statement is the result.
+
+    :param db_with_contact: The mock database session returning the updated contact
+    :param existing_contact: The contact being updated
+    :return: The contact_data
+    :doc-author: Trelent
+    """
+    db = db_with_contact
+    updated = update_contact(db, existing_contact.id, CONTACT_UPDATE, 2)
+    assert updated == existing_contact
+    db.execute.assert_called_once()
+    params = db.execute.call_args.args[0].compile().params
+    assert {field: params[field] for field in CONTACT_UPDATE_FIELDS} == CONTACT_UPDATE_FIELDS
+    assert params["id_1"] == existing_contact.id
+    assert params["owner_id_1"] == 2
+    db.commit.assert_called_once()
+    db.refresh.assert_not_called()
+
+def test_delete_contact(db_with_contact, existing_contact):
+    """
+    The test_delete_contact function tests the delete_contact function.
+    It does this by creating a mock contact object and setting it as the return value of db.get()
+    Then, it calls delete_contact with that mock database and contact id. It asserts that the result is equal to our mocked contact object,
+    and then asserts that db.delete() was called once with our mocked contact object.
+
+    :param db_with_contact: The mock database session returning the contact
+    :param existing_contact: The contact being deleted
+    :return: The contact that was deleted
+    :doc-author: Trelent
+    """
+    db = db_with_contact
+    assert delete_contact(db, existing_contact.id) == existing_contact
+    db.delete.assert_called_once_with(existing_contact)
+    db.commit.assert_called_once()
+
+def test_search_contacts():
+    """
+    The test_search_contacts function tests the search_contacts function.
+    It does this by creating a mock database object, and then setting up that mock to return a list of contacts when it is queried.
+    The test then calls the search_contacts function with the query &quot;John&quot; and user id 1, which should return all contacts whose first name is John.
+
+    :return: The contacts list
+    :doc-author: Trelent
+    """
+    user_id = 1
+    query = "Dexter"
+    contacts = [Contact(id=1, first_name="Dexter", last_name="Morgan", owner_id=user_id)]
+    assert search_contacts(stub_session(rows=contacts), query, user_id) == contacts
+
+def test_get_upcoming_birthdays(freeze_today):
+    """
+    The test_get_upcoming_birthdays function tests the get_upcoming_birthdays function.
+    It does this by creating a mock database object, and then setting up some test data to be returned from that mock database.
+    The test data is a list of Contact objects with an id of 1, first name &quot;John&quot;, last name &quot;Doe&quot;, birthday 3 days from today, and owner id 1.
+    Then it calls the get_upcoming_birthdays function with the mock db object and user id 1 as arguments. It asserts that result is equal to contacts.
+
+    :param freeze_today: Freeze today's date for crud
+    :return: The contacts list
+    :doc-author: Trelent
+    """
+    freeze_today(TODAY)
+    user_id = 1
+    contacts = [Contact(id=1, first_name="Dexter", last_name="Morgan", birthday=UPCOMING_BIRTHDAY, owner_id=user_id)]
+    assert get_upcoming_birthdays(stub_session(rows=contacts), user_id) == contacts
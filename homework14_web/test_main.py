@@ -1,61 +1,73 @@
 import crud
 import pytest
-from main import app
-from database import Base, get_db
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from fastapi.testclient import TestClient
+import schemas
+from datetime import date
+from models import Contact, User, birthday_key, create_missing_indexes, create_search_indexes
+from sqlalchemy import create_engine, inspect, select
+from sqlalchemy.orm import Session
+from database import Base
+from unittest.mock import patch
 
-DATABASE_URL = "sqlite:///./test.db"
+CONTACT_DATA = {
+    "first_name": "Dexter",
+    "last_name": "Morgan",
+    "email": "dexter@example.com",
+    "phone_number": "123456789",
+    "birthday": "2000-01-01"
+}
 
-engine = create_engine(DATABASE_URL)
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
-        yield db
-    finally:
-        db.close()
+@pytest.fixture
+def user(db):
+    """
+    The user function is a fixture that registers the test user, not yet verified, in the test's transaction.
 
-app.dependency_overrides[get_db] = override_get_db
+    :param db: The database session of the test
+    :return: The registered user
+    :doc-author: Trelent
+    """
+    return crud.create_user(db, schemas.UserCreate(email="test@example.com", password="password"))
 
-@pytest.fixture(scope="module")
-def client():
+@pytest.fixture
+def auth_headers(db, user):
     """
-    The client function is a fixture that creates the database and returns a test client.
-    The test client can be used to make requests to the API, which will be run against an in-memory SQLite database.
-    After all tests have been run, the database is dropped.
+    The auth_headers function is a fixture that verifies the test user
+    and returns the authorization headers for the tests that need an authenticated user.
 
-    :return: A testclient instance
+    :param db: The database session of the test
+    :param user: The registered test user
+    :return: A dict with the bearer authorization header
     :doc-author: Trelent
     """
-    Base.metadata.create_all(bind=engine)
-    with TestClient(app) as client:
-        yield client
-    Base.metadata.drop_all(bind=engine)
+    user.is_active = True
+    db.commit()
+    access_token = crud.create_access_token(data={"sub": user.email})
+    return {"Authorization": f"Bearer {access_token}"}
 
-def test_register_user(client):
+def test_register_user(client, db):
     """
     The test_register_user function tests the /auth/register endpoint.
     It does so by making a POST request to that endpoint with an email and password,
     and then asserts that the response has status code 200 (OK) and contains an email key in its JSON body.
 
     :param client: Make requests to the flask application
+    :param db: Roll the registration back after the test
     :return: A 200 response and a json object with the email address
     :doc-author: Trelent
     """
-    response = client.post("/auth/register", json={"email": "test@example.com", "password": "password"})
+    with patch("auth.send_verification_email") as send_verification_email:
+        response = client.post("/auth/register", json={"email": "test@example.com", "password": "password"})
     assert response.status_code == 200
     assert response.json()["email"] == "test@example.com"
+    send_verification_email.assert_called_once()
 
-def test_login(client):
+def test_login(client, user):
     """
     The test_login function tests the login endpoint.
     It does so by sending a POST request to /auth/token with the username and password of our test user.
     If this is successful, we should get back an access token in JSON format.
 
     :param client: Make requests to the flask application
+    :param user: The registered test user
     :return: A token that can be used to authenticate with the api
     :doc-author: Trelent
     """
@@ -65,50 +77,218 @@ def test_login(client):
     assert "access_token" in data
     assert data["token_type"] == "bearer"
 
-def test_verify_email(client):
+def test_verify_email(client, db, user):
     """
     The test_verify_email function tests the /auth/verify endpoint.
-    It does so by creating a user, generating an access token for that user, and then calling the /auth/verify endpoint with that token.
+    It does so by generating an access token for the registered user's email, and then calling the /auth/verify endpoint with that token.
     The test asserts that the response status code is 200 (OK), and also checks to make sure that the JSON response contains a msg key with value &quot;Email verified successfully&quot;.
-    Finally, it refreshes our database session to ensure we have up-to-date data about our User object in memory.
+    Finally, it loads the user once, after the verification, to check that the account is active.
+    The endpoint shares the test's session, so the session is expired first and the user is read back from the database,
+    not from the object the endpoint changed in memory.
 
     :param client: Make requests to the api
+    :param db: Read the user from the test database
+    :param user: The registered test user
     :return: A status code of 200, a message saying &quot;email verified successfully&quot;, and asserts that the user is active
     :doc-author: Trelent
     """
-    db = TestingSessionLocal()
-    user = crud.get_user(db, email="test@example.com")
-    token = crud.create_access_token(data={"sub": user.email})
+    token = crud.create_access_token(data={"sub": "test@example.com"})
     response = client.get(f"/auth/verify?token={token}")
     assert response.status_code == 200
     assert response.json()["msg"] == "Email verified successfully"
-    db.refresh(user)
-    assert user.is_active
+    db.expire_all()
+    assert crud.get_user(db, email="test@example.com").is_active
+
+def test_verify_email_refreshes_cached_user(client, db, user):
+    """
+    The test_verify_email_refreshes_cached_user function tests that verifying an email takes effect right away
+    for tokens whose user crud has already cached as inactive, instead of only when the cache entry expires.
 
-def test_create_contact(client):
+    :param client: Make requests to the api
+    :param db: The database session of the test
+    :param user: The registered, not yet verified test user
+    :return: The responses before and after the verification
+    :doc-author: Trelent
+    """
+    token = crud.create_access_token(data={"sub": user.email})
+    headers = {"Authorization": f"Bearer {token}"}
+    response = client.get("/contacts/", headers=headers)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Inactive user"
+
+    assert client.get(f"/auth/verify?token={token}").status_code == 200
+
+    assert client.get("/contacts/", headers=headers).status_code == 200
+
+def test_create_contact(client, auth_headers):
     """
     The test_create_contact function tests the creation of a contact.
-    It does so by first logging in as the test user, then creating a new contact with valid data.
+    It does so as the logged in test user, creating a new contact with valid data.
     The response is checked to ensure that it has an HTTP status code of 200 and that the returned JSON contains
     the correct first name.
 
     :param client: Make requests to the flask application
+    :param auth_headers: Authenticate the requests as the test user
     :return: A response object
     :doc-author: Trelent
     """
-    login_response = client.post("/auth/token", data={"username": "test@example.com", "password": "password"})
-    access_token = login_response.json()["access_token"]
-    headers = {"Authorization": f"Bearer {access_token}"}
+    response = client.post("/contacts/", json=CONTACT_DATA, headers=auth_headers)
+    assert response.status_code == 200
+    print(response.json())
+    assert response.json()["first_name"] == "Dexter"
+
+def test_read_contacts(client, auth_headers):
+    """
+    The test_read_contacts function tests listing the contacts of the logged in user.
+    It creates a contact and fetches /contacts/ as the logged in test user, which must return that contact
+    serialized with exactly the fields of schemas.Contact.
+
+    :param client: Make requests to the flask application
+    :param auth_headers: Authenticate the requests as the test user
+    :return: A list with the created contact
+    :doc-author: Trelent
+    """
+    assert client.post("/contacts/", json=CONTACT_DATA, headers=auth_headers).status_code == 200
+    response = client.get("/contacts/", headers=auth_headers)
+    assert response.status_code == 200
+    contacts = response.json()
+    assert len(contacts) == 1
+    assert contacts[0]["first_name"] == "Dexter"
+    assert contacts[0]["birthday"] == "2000-01-01"
+    assert set(contacts[0]) == set(schemas.Contact.model_fields)
+
+def test_list_contacts_no_nplus_one(client, auth_headers, raise_on_lazy_load, assert_query_count):
+    """
+    The test_list_contacts_no_nplus_one function tests that listing contacts does not lazy load anything per contact.
+    It adds five contacts and lists them while every lazy load raises, so an N+1 query in
+    the list endpoint (e.g. on Contact.owner) fails the request instead of going unnoticed.
+    The request may also run at most two SELECT statements, one for the user and one for the contacts.
 
-    contact_data = {
-        "first_name": "Dexter",
-        "last_name": "Morgan",
-        "email": "dexter@example.com",
-        "phone_number": "123456789",
-        "birthday": "2000-01-01"
-    }
+    :param client: Make requests to the api
+    :param auth_headers: Authenticate the requests as the test user
+    :param raise_on_lazy_load: Make lazy loads raise during the test
+    :param assert_query_count: Limit the number of SELECT statements of the request
+    :return: The list of contacts
+    :doc-author: Trelent
+    """
+    for number in range(5):
+        contact_data = {
+            "first_name": f"Contact{number}",
+            "last_name": "Morgan",
+            "email": f"contact{number}@example.com",
+            "phone_number": "123456789",
+            "birthday": "2000-01-01"
+        }
+        assert client.post("/contacts/", json=contact_data, headers=auth_headers).status_code == 200
 
-    response = client.post("/contacts/", json=contact_data, headers=headers)
+    with assert_query_count(max_queries=2):
+        response = client.get("/contacts/", headers=auth_headers)
     assert response.status_code == 200
-    print(response.json())
-    assert response.json()["first_name"] == "Dexter"
\ No newline at end of file
+    assert len(response.json()) == 5
+
+def test_search_contacts(client, auth_headers):
+    """
+    The test_search_contacts function tests the /contacts/search/ endpoint against the test database.
+    A query of three or more characters is matched through the contacts_fts trigram index, anywhere in a name or email,
+    while a shorter query falls back to a substring scan.
+
+    :param client: Make requests to the api
+    :param auth_headers: Authenticate the requests as the test user
+    :return: The matching contacts
+    :doc-author: Trelent
+    """
+    other_contact = dict(CONTACT_DATA, first_name="Debra", email="debra@example.com")
+    for contact_data in (CONTACT_DATA, other_contact):
+        assert client.post("/contacts/", json=contact_data, headers=auth_headers).status_code == 200
+
+    response = client.get("/contacts/search/", params={"query": "exte"}, headers=auth_headers)
+    assert response.status_code == 200
+    assert [contact["first_name"] for contact in response.json()] == ["Dexter"]
+
+    response = client.get("/contacts/search/", params={"query": "Mo"}, headers=auth_headers)
+    assert response.status_code == 200
+    assert len(response.json()) == 2
+
+def test_create_search_indexes_on_existing_database():
+    """
+    The test_create_search_indexes_on_existing_database function tests that create_search_indexes adds the contacts_fts index
+    to a database whose contacts table already exists, and indexes the contacts that are already stored in it.
+
+    :return: The contact found through the new index
+    :doc-author: Trelent
+    """
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    with Session(engine) as db:
+        user = User(email="test@example.com", hashed_password="hashed_password")
+        db.add(user)
+        db.flush()
+        db.add(Contact(first_name="Dexter", last_name="Morgan", email="dexter@example.com", owner_id=user.id))
+        db.commit()
+        assert "contacts_fts" not in inspect(engine).get_table_names()
+
+        with engine.begin() as connection:
+            create_search_indexes(connection)
+
+        assert [contact.first_name for contact in crud.search_contacts(db, "exte", user.id)] == ["Dexter"]
+    engine.dispose()
+
+def test_create_missing_indexes_on_existing_database():
+    """
+    The test_create_missing_indexes_on_existing_database function tests that create_missing_indexes adds the model indexes
+    that a database created before them lacks, while create_all leaves its existing tables alone.
+    The indexes are read from sqlite_master, since SQLite's inspector leaves out expression indexes like the birthday key.
+
+    :return: The index names of the database
+    :doc-author: Trelent
+    """
+    added_indexes = {"ix_contacts_owner_id", "ix_contacts_owner_id_birthday_key"}
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        for name in added_indexes:
+            connection.exec_driver_sql(f"DROP INDEX {name}")
+    Base.metadata.create_all(bind=engine)
+
+    with engine.begin() as connection:
+        index_names = set(connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'").scalars())
+        assert not added_indexes & index_names
+        create_missing_indexes(connection)
+        index_names = set(connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'").scalars())
+        assert added_indexes <= index_names
+    engine.dispose()
+
+@pytest.mark.parametrize("today, birthdays, upcoming", [
+    (date(2024, 6, 1), [date(1999, 6, 5), date(1999, 6, 20), date(1999, 5, 31)], ["1999-06-05"]),
+    (date(2024, 12, 28), [date(1990, 12, 30), date(1985, 1, 3), date(2000, 1, 10), date(1970, 12, 27)],
+     ["1985-01-03", "1990-12-30"]),
+])
+def test_get_upcoming_birthdays(db, user, freeze_today, today, birthdays, upcoming):
+    """
+    The test_get_upcoming_birthdays function tests get_upcoming_birthdays against the test database.
+    Birthdays in the next week match whatever the year of birth, also when the week wraps from December into January,
+    and the query is answered from the ix_contacts_owner_id_birthday_key index.
+
+    :param db: The database session of the test
+    :param user: The owner of the contacts
+    :param freeze_today: Freeze the date crud sees as today
+    :param today: The frozen date
+    :param birthdays: The birthdays of the stored contacts
+    :param upcoming: The birthdays expected in the result
+    :return: The contacts with upcoming birthdays
+    :doc-author: Trelent
+    """
+    freeze_today(today)
+    for number, birthday in enumerate(birthdays):
+        contact = schemas.ContactCreate(first_name=f"Contact{number}", last_name="Morgan", email=f"contact{number}@example.com",
+                                        phone_number="123456789", birthday=birthday)
+        crud.create_contact(db, contact, user.id)
+
+    contacts = crud.get_upcoming_birthdays(db, user.id)
+    assert sorted(contact.birthday.isoformat() for contact in contacts) == upcoming
+
+    stmt = select(Contact).where(Contact.owner_id == user.id, birthday_key.between(601, 608))
+    compiled = stmt.compile(db.get_bind())
+    parameters = tuple(compiled.params[name] for name in compiled.positiontup)
+    plan = " ".join(str(row) for row in db.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", parameters))
+    assert "ix_contacts_owner_id_birthday_key" in plan
@@ -18,7 +18,17 @@ conf = ConnectionConfig(
     USE_CREDENTIALS=True
 )
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__time_cost=config.ARGON2_TIME_COST,
+    argon2__memory_cost=config.ARGON2_MEMORY_COST,
+    argon2__parallelism=config.ARGON2_PARALLELISM
+)
+
+if config.TESTING:
+    # The test suite hashes and verifies passwords on every auth test, so use the cheapest costs the schemes allow.
+    pwd_context.update(argon2__time_cost=1, argon2__memory_cost=8, bcrypt__rounds=4)
 
 def verify_password(plain_password, hashed_password):
     """
@@ -32,10 +42,23 @@ def verify_password(plain_password, hashed_password):
     """
     return pwd_context.verify(plain_password, hashed_password)
 
+def verify_and_update_password(plain_password, hashed_password):
+    """
+    The verify_and_update_password function verifies a plain-text password against a stored hash,
+    like verify_password does, and additionally returns a fresh argon2 hash when the stored one
+    uses a deprecated scheme (bcrypt) or outdated argon2 cost settings.
+
+    :param plain_password: Pass in the password that is entered by the user
+    :param hashed_password: Store the hashed password in the database
+    :return: A tuple of whether the password is correct and the new hash, or None if no rehash is needed
+    :doc-author: Trelent
+    """
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
 def get_password_hash(password):
     """
     The get_password_hash function takes a password as input and returns the hashed version of that password.
-    The hash is generated using the pwd_context object from Flask-Bcrypt, which uses bcrypt to generate hashes.
+    The hash is generated using the pwd_context object from passlib, which uses argon2 to generate hashes.
 
     :param password: Get the password from the user
     :return: The hash of the password